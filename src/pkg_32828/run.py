@@ -4,30 +4,96 @@
 Purpose: Delete GitHub Branches
 """
 import os
+import re
 import sys
-from contextlib import suppress
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
-from typing import Set, Tuple
+from functools import lru_cache
+from operator import attrgetter
+from typing import (
+    FrozenSet,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+from urllib.parse import quote
 
 import click
 from github import (
     Auth,
     BadCredentialsException,
     Github,
+    GithubException,
+    GithubRetry,
     Repository,
     UnknownObjectException,
 )
+from github.Requester import Requester
 
 from pkg_32828 import __version__
 
 
+REPO_URL_RE = re.compile(r'(?:https://github\.com/|git@github\.com:)([^/]+)/([^/]+?)(?:\.git)?/?')
+
+
+@dataclass(frozen=True)
+class Branch:
+    """
+    Branch fields used to decide and report deletes, built from prefetched GraphQL data
+
+    Parameter(s):
+    name            : branch name
+    last_commit_date: committed date of the branch head commit
+    protected       : branch has a branch protection rule
+    """
+    name: str
+    last_commit_date: datetime
+    protected: bool = False
+
+
+@dataclass(frozen=True)
+class Inputs:
+    """
+    Validated user inputs
+
+    Parameter(s):
+    dry_run      : skip delete when true
+    max_idle_days: maximum number of days that the branch has been idle (zero or more)
+    """
+    dry_run: bool
+    max_idle_days: int
+
+    def __post_init__(self):
+        if not isinstance(self.dry_run, bool):
+            raise ValueError(f'dry-run ({self.dry_run}) must be true or false')
+        if not isinstance(self.max_idle_days, int) or isinstance(self.max_idle_days, bool) or self.max_idle_days < 0:
+            raise ValueError(f'max-idle-days ({self.max_idle_days}) must be an integer of zero or more')
+
+
+def format_utc(dt: datetime) -> str:
+    """
+    format a UTC datetime as 'YYYY-MM-DD HH:MM:SS'
+
+    * isoformat is cheaper than strftime; slicing drops the '+00:00' offset since output is labelled UTC
+    """
+    return dt.isoformat(sep=' ', timespec='seconds')[:19]
+
+
+@lru_cache(maxsize=1)
 def get_auth() -> Github:
     """
-    Creates an instance of Github class to interact with GitHub API
+    Creates an instance of Github class to interact with GitHub API (cached for the process lifetime)
+
+    * pool_size keeps enough keep-alive connections for the concurrent deletes in delete_branches
+    * GithubRetry retries transient 5xx errors and still honors GitHub rate limit (403) responses
     """
     try:
         gh_token = os.environ['GH_TOKEN']
-        gh = Github(auth=Auth.Token(gh_token), per_page=100)
+        retry = GithubRetry(total=5, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        gh = Github(auth=Auth.Token(gh_token), per_page=100, retry=retry, pool_size=32)
         gh.get_rate_limit()
         return gh
 
@@ -37,6 +103,18 @@ def get_auth() -> Github:
         raise PermissionError('Invalid GitHub Token (GH_TOKEN)')
 
 
+@lru_cache(maxsize=32)
+def _get_repo_cached(gh: Github, owner_repo: str) -> Repository.Repository:
+    """
+    Get repository object once per Github instance and owner/repo
+
+    Parameter(s):
+    gh        : github object
+    owner_repo: owner/repo (e.g. tagdots-dev/branch-test)
+    """
+    return gh.get_repo(owner_repo)
+
+
 def get_repo(gh: Github, repo_url: str) -> Repository.Repository:
     """
     Get owner/repo for pyGitHub to interact with GitHub API
@@ -45,89 +123,186 @@ def get_repo(gh: Github, repo_url: str) -> Repository.Repository:
     repo_url: repository url (e.g. https://github.com/{user/org}/repo.git)
     """
     try:
-        list_gh_substrings = ['https://github.com', 'git@github.com:']
-        if not any(gh_substring in repo_url for gh_substring in list_gh_substrings):
+        match = REPO_URL_RE.fullmatch(repo_url)
+        if not match:
             raise ValueError(f'repo-url ({repo_url}) is invalid')
 
-        owner_repo = '/'.join(repo_url.rsplit('/', 2)[-2:]).\
-            replace('.git', '').replace('git@github.com:', '').replace('https://github.com/', '')
-
-        repo = gh.get_repo(owner_repo)
+        owner_repo = f'{match[1]}/{match[2]}'
+        repo = _get_repo_cached(gh, owner_repo)
         return repo
 
     except UnknownObjectException as e:
         raise ValueError(f'{repo_url} repository not found ({e.status})')
 
 
-def get_exempt_branches(repo: Repository.Repository, set_exclude_branches: set) -> set:
+BRANCHES_QUERY = """
+query($owner: String!, $name: String!, $perPage: Int!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    refs(refPrefix: "refs/heads/", first: $perPage, after: $cursor) {
+      pageInfo { endCursor hasNextPage }
+      nodes {
+        name
+        branchProtectionRule { id }
+        refUpdateRule { pattern }
+        rules(first: 1) { totalCount }
+        target { ... on Commit { committedDate } }
+      }
+    }
+  }
+}
+"""
+
+PULL_REQUESTS_QUERY = """
+query($owner: String!, $name: String!, $perPage: Int!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(states: OPEN, first: $perPage, after: $cursor) {
+      pageInfo { endCursor hasNextPage }
+      nodes { baseRefName headRefName }
+    }
+  }
+}
+"""
+
+
+def _paginate_gql(requester: Requester, query: str, variables: dict, path_to_pageinfo: List[str]) -> Iterator[list]:
+    """
+    Yield the nodes of a GraphQL connection one page at a time, following endCursor until hasNextPage is false
+
+    Parameter(s):
+    requester       : github requester used to post the query
+    query           : GraphQL query taking a $cursor variable
+    variables       : GraphQL variables (without cursor)
+    path_to_pageinfo: keys under 'data' leading to the connection (e.g. ['repository', 'refs'])
+    """
+    cursor = None
+    while True:
+        _, data = requester.graphql_query(query, {**variables, 'cursor': cursor})
+        connection = data['data']
+        for key in path_to_pageinfo:
+            connection = connection[key]
+
+        yield connection['nodes']
+
+        if not connection['pageInfo']['hasNextPage']:
+            return
+        cursor = connection['pageInfo']['endCursor']
+
+
+def _is_protected(node: dict) -> bool:
+    """
+    Treat a branch as protected when any protection source applies
+
+    * branchProtectionRule: classic protection rule (may be hidden from non-admin tokens)
+    * refUpdateRule       : protection rule as seen by non-admin tokens
+    * rules               : repository ruleset rules targeting the branch
+
+    Parameter(s):
+    node: GraphQL ref node from BRANCHES_QUERY
+    """
+    return bool(
+        node['branchProtectionRule']
+        or node['refUpdateRule']
+        or (node['rules'] or {}).get('totalCount', 0)
+    )
+
+
+def _fetch_branch_graph(repo: Repository.Repository,
+                        per_page: int = 100) -> Tuple[List[Branch], List[Tuple[str, str]], str]:
+    """
+    Fetch branches (with last commit date and protection), open pull request refs, and default branch
+    with cursor-paginated GraphQL queries
+
+    Parameter(s):
+    repo    : github repository object
+    per_page: number of nodes per page (GraphQL maximum is 100)
+    """
+    owner, name = repo.full_name.split('/', 1)
+    variables = {'owner': owner, 'name': name, 'perPage': per_page}
+
+    branches = []
+    for nodes in _paginate_gql(repo.requester, BRANCHES_QUERY, variables, ['repository', 'refs']):
+        branches.extend(
+            Branch(
+                name=node['name'],
+                last_commit_date=datetime.fromisoformat(node['target']['committedDate']),
+                protected=_is_protected(node),
+            )
+            for node in nodes
+        )
+
+    pr_refs = []
+    for nodes in _paginate_gql(repo.requester, PULL_REQUESTS_QUERY, variables, ['repository', 'pullRequests']):
+        pr_refs.extend((node['baseRefName'], node['headRefName']) for node in nodes)
+
+    return branches, pr_refs, repo.default_branch
+
+
+def get_exempt_branches(branch_graph: tuple, set_exclude_branches: FrozenSet[str]) -> FrozenSet[str]:
     """
     Add default, protected, and PR base branches to build a set of exempt branches
     Remove user specified branches from exempt branches if the specified branches do not exist
 
     Parameter(s):
-    repo                     : github repository object
+    branch_graph        : branches, pull request refs, and default branch from _fetch_branch_graph
     set_exclude_branches: set of branch(es) excluded from delete via user inputs
     """
+    branches, pr_refs, default_branch = branch_graph
 
-    """use copy() here to prevent 'Exception Error: Set changed size during iteration'"""
-    set_exempt_branches = set_exclude_branches.copy()
-    all_branches = repo.get_branches()
-    set_all_branches = set()
-
-    """iterate all branches"""
-    for branch in all_branches:
-        set_all_branches.add(branch.name)
+    """build a mutable copy here; set_exclude_branches is iterated below while set_exempt_branches changes"""
+    set_exempt_branches = set(set_exclude_branches)
+    set_all_branches = {branch.name for branch in branches}
 
     """remove branch from set_exempt_branches if the branch is not found in existing branches"""
     if len(set_exclude_branches) > 0:
         for user_exclude_branch in set_exclude_branches:
             if user_exclude_branch not in set_all_branches:
                 set_exempt_branches.remove(user_exclude_branch)
-        print(f'Refined User Exclude Branch(es): {set_exempt_branches}') if len(set_exempt_branches) else ''
+        if len(set_exempt_branches):
+            print(f'Refined User Exclude Branch(es): {set_exempt_branches}')
 
     """add to set_exempt_branch - default branch"""
-    default_branch = repo.default_branch
     set_exempt_branches.add(default_branch)
     print(f'Default Branch           : {default_branch}')
 
-    """add protected branch to set_exempt_branch"""
-    for branch in all_branches:
+    """add protected branch to set_exempt_branch (skip branches already exempt)"""
+    for branch in branches:
+        if branch.name in set_exempt_branches:
+            continue
         if branch.protected:
             set_exempt_branches.add(branch.name)
             print(f'Protected Branch         : {branch.name}')
 
     """add to set_exempt_branch - PR head branch"""
-    pulls = repo.get_pulls()
-    for pull in pulls:
-        base_branch = pull.base.ref
+    for base_branch, head_branch in pr_refs:
         set_exempt_branches.add(base_branch)
-
-        head_branch = pull.head.ref
         set_exempt_branches.add(head_branch)
         print(f'Pull Request Head Branch : {head_branch}')
 
-    return set_exempt_branches
+    return frozenset(set_exempt_branches)
 
 
-def get_branches_to_delete(repo: Repository.Repository, set_exempt_branches: set,
-                           branch_max_idle: datetime) -> Tuple[list, int]:
+def get_branches_to_delete(branch_graph: tuple, set_exempt_branches: FrozenSet[str],
+                           branch_max_idle: datetime) -> Tuple[List[Branch], int]:
     """
-    get to-be-deleted branches from not-exempt branches
+    get to-be-deleted branches (oldest last commit first) from not-exempt branches
 
     Parameter(s):
-    repo               : github repository object
+    branch_graph       : branches, pull request refs, and default branch from _fetch_branch_graph
     set_exempt_branches: set of exempt branches excluded from delete
     branch_max_idle    : datetime on maximum number of days that the branch has been idle
     """
-    list_branches_to_delete = []
-    total_branch_count = 0
-    count_not_exempt_branch = 0
-    for branch in repo.get_branches():
-        total_branch_count += 1
-        if branch.name not in set_exempt_branches:
-            count_not_exempt_branch += 1
-            if branch_max_idle > branch.commit.commit.committer.date:
-                list_branches_to_delete.append(branch.name)
+    branches = branch_graph[0]
+    exempt = frozenset(set_exempt_branches)
+
+    """
+    sort by last commit date so branches are deleted oldest first (this is for ordering, not speed);
+    every branch before bisect_left is idle (last commit date < cutoff), so that slice is filtered on exempt only
+    """
+    branches_by_date = sorted(branches, key=attrgetter('last_commit_date'))
+    idle_count = bisect_left(branches_by_date, branch_max_idle, key=attrgetter('last_commit_date'))
+    list_branches_to_delete = [branch for branch in branches_by_date[:idle_count] if branch.name not in exempt]
+    total_branch_count = len(branches)
+    count_not_exempt_branch = sum(1 for branch in branches if branch.name not in exempt)
 
     print(f'\nTotal Number of Branches                         : {total_branch_count}')
     print(f'Total Number of Branches (Exempt-From-Delete)    : {len(set_exempt_branches)}')
@@ -136,8 +311,32 @@ def get_branches_to_delete(repo: Repository.Repository, set_exempt_branches: set
     return list_branches_to_delete, count_not_exempt_branch
 
 
-def delete_branches(repo: Repository.Repository, dry_run: bool, max_idle_days: int, list_branches_to_delete: list,
-                    count_not_exempt_branch: int) -> bool:
+def _delete_one(repo: Repository.Repository, branch_to_delete: str, dry_run: bool) -> None:
+    """
+    delete a single branch; rate limit (403/429 retry-after) and 5xx retries are handled by GithubRetry in get_auth
+
+    Parameter(s):
+    repo            : github repository object
+    branch_to_delete: branch name
+    dry_run         : skip delete when true
+    """
+    if dry_run:
+        return
+
+    repo.requester.requestJsonAndCheck("DELETE", f'{repo.url}/git/refs/heads/{quote(branch_to_delete)}')
+
+
+def _describe_error(error: Exception) -> str:
+    """
+    short description of a failed delete: HTTP status for GitHub errors, exception type otherwise
+    """
+    if isinstance(error, GithubException):
+        return str(error.status)
+    return type(error).__name__
+
+
+def delete_branches(repo: Repository.Repository, dry_run: bool, max_idle_days: int, list_branches_to_delete: List[Branch],
+                    count_not_exempt_branch: int, max_workers: int = 16) -> bool:
     """
     delete branches
 
@@ -146,42 +345,59 @@ def delete_branches(repo: Repository.Repository, dry_run: bool, max_idle_days: i
     max_idle_days          : maximum number of days that the branch has been idle (without new commits)
     list_branches_to_delete: list of branches to delete
     count_not_exempt_branch: number of branches not exempt from delete
+    max_workers            : number of concurrent delete requests
+
+    * raises RuntimeError after the batch when any delete failed
     """
     dry_run_msg = "(MOCK) " if dry_run else "✅ "
     print(f'\nFrom {count_not_exempt_branch} Not-Exempt-From-Delete branch(es), ' +
           f'{len(list_branches_to_delete)} branch is idle more than {max_idle_days} day(s)')
     print("-" * 90)
     if len(list_branches_to_delete) > 0:
-        for branch_to_delete in list_branches_to_delete:
-            branch = repo.get_branch(branch_to_delete)
-            branch_last_commit_time = branch.commit.commit.committer.date.strftime("%Y-%m-%d %H:%M:%S")
-
-            ref = repo.get_git_ref(f"heads/{branch_to_delete}")
-            ref.delete() if not dry_run else ""
-
-            print(f'{dry_run_msg}Delete branch - last update UTC {branch_last_commit_time}: {branch_to_delete}')
+        def _delete(branch: Branch) -> Tuple[Branch, Optional[Exception]]:
+            """transport errors (requests' RequestException derives from OSError) are reported per branch too"""
+            try:
+                _delete_one(repo, branch.name, dry_run)
+                return branch, None
+            except (GithubException, OSError) as e:
+                return branch, e
+
+        """executor.map hands results back in input order; one failed delete does not abort the batch"""
+        count_failed = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for branch, error in executor.map(_delete, list_branches_to_delete):
+                branch_last_commit_time = format_utc(branch.last_commit_date)
+                status_msg = dry_run_msg if error is None else "❌ "
+                error_msg = "" if error is None else f" ({_describe_error(error)})"
+                count_failed += error is not None
+                print(f'{status_msg}Delete branch - last update UTC {branch_last_commit_time}: ' +
+                      f'{branch.name}{error_msg}')
+
+        """report failures after the whole batch has run so callers see a non-zero exit"""
+        if count_failed:
+            raise RuntimeError(f'{count_failed} of {len(list_branches_to_delete)} branch(es) failed to delete')
     else:
         print("There is no branch to delete")
 
     return True
 
 
-def build_set_exclude_branches(exclude_branches: str) -> Set[str]:
+def build_set_exclude_branches(exclude_branches: str) -> FrozenSet[str]:
     """
-    turn exclude_branches into a set
+    turn exclude_branches into a frozenset
 
     Parameter(s)
     exclude_branches: exclude branches from delete (string)
 
     * use list method .split to split exclude_branches (str).  This convert str to list
     * use map to strip space before and after each element on the list
-    * turn list into set to ensure unqiue branch name
+    * turn list into frozenset to ensure unqiue branch name
     """
     if isinstance(exclude_branches, str):
         list_exclude_branches = exclude_branches.split(',')
-        return set(map(str.strip, list_exclude_branches))
+        return frozenset(map(str.strip, list_exclude_branches))
     else:
-        return set()
+        return frozenset()
 
 
 @click.command()
@@ -195,26 +411,28 @@ def main(dry_run: bool, repo_url: str, exclude_branches: str, max_idle_days: int
           f"{exclude_branches}, max-idle-days: {max_idle_days})\n")
 
     try:
+        inputs = Inputs(dry_run=dry_run, max_idle_days=max_idle_days)
         gh = get_auth()
         repo = get_repo(gh, repo_url)
         set_exclude_branches = build_set_exclude_branches(exclude_branches)
-        with suppress(ValueError):
-            max_idle_days = int(max_idle_days)
 
         """set time"""
         current_datetime_tzutc = datetime.now(timezone.utc)
-        branch_max_idle = current_datetime_tzutc - timedelta(days=max_idle_days)
-        print(f'Current Time (UTC): {current_datetime_tzutc.strftime("%Y-%m-%d %H:%M:%S")}\n')
+        branch_max_idle = current_datetime_tzutc - timedelta(days=inputs.max_idle_days)
+        print(f'Current Time (UTC): {format_utc(current_datetime_tzutc)}\n')
+
+        """fetch branches and pull requests"""
+        branch_graph = _fetch_branch_graph(repo)
 
         """build exempt branches"""
-        set_exempt_branches = get_exempt_branches(repo, set_exclude_branches)
+        set_exempt_branches = get_exempt_branches(branch_graph, set_exclude_branches)
 
         """get list of to-be-deleted branches and number of not-exempt branch"""
         list_branches_to_delete, count_not_exempt_branch = \
-            get_branches_to_delete(repo, set_exempt_branches, branch_max_idle)
+            get_branches_to_delete(branch_graph, set_exempt_branches, branch_max_idle)
 
         """delete to-be-deleted branches"""
-        delete_branches(repo, dry_run, max_idle_days, list_branches_to_delete, count_not_exempt_branch)
+        delete_branches(repo, inputs.dry_run, inputs.max_idle_days, list_branches_to_delete, count_not_exempt_branch)
 
     except Exception as e:
         print(f'Error: {e}\n')
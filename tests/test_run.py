@@ -9,12 +9,20 @@ from datetime import datetime, timedelta, timezone
 from unittest.mock import Mock, patch
 
 import pytest
+import requests
 from click.testing import CliRunner
-from github import Repository
+from github import GithubException, Repository
 
 from pkg_32828.run import (
+    Branch,
+    Inputs,
+    _delete_one,
+    _fetch_branch_graph,
+    _get_repo_cached,
+    _paginate_gql,
     build_set_exclude_branches,
     delete_branches,
+    format_utc,
     get_auth,
     get_branches_to_delete,
     get_exempt_branches,
@@ -23,6 +31,15 @@ from pkg_32828.run import (
 )
 
 
+@pytest.fixture(autouse=True)
+def clear_caches():
+    get_auth.cache_clear()
+    _get_repo_cached.cache_clear()
+    yield
+    get_auth.cache_clear()
+    _get_repo_cached.cache_clear()
+
+
 @pytest.fixture
 def mock_repo():
     repo = Mock(spec=Repository.Repository)
@@ -31,25 +48,38 @@ def mock_repo():
 
 
 @pytest.fixture
-def mock_branch():
-    def _create_branch(name, protected=False, last_commit_days_ago=0):
-        branch = Mock()
-        branch.name = name
-        branch.protected = protected
-        commit_date = datetime.now(timezone.utc) - timedelta(days=last_commit_days_ago)
-        branch.commit.commit.committer.date = commit_date
-        return branch
-    return _create_branch
+def mock_branch_graph():
+    def _create_branch_graph(branches, pr_refs=None, default_branch="main", protected=None):
+        now = datetime.now(timezone.utc)
+        protected = protected or set()
+        list_branches = [
+            Branch(name, now - timedelta(days=days_ago), protected=name in protected)
+            for name, days_ago in branches.items()
+        ]
+        return list_branches, pr_refs or [], default_branch
+    return _create_branch_graph
 
 
-@pytest.fixture
-def mock_pull():
-    def _create_pull(base_ref, head_ref):
-        pull = Mock()
-        pull.base.ref = base_ref
-        pull.head.ref = head_ref
-        return pull
-    return _create_pull
+class TestFormatUtc:
+    def test_format_utc(self):
+        assert format_utc(datetime(2025, 1, 2, 3, 4, 5, 678, tzinfo=timezone.utc)) == "2025-01-02 03:04:05"
+
+
+class TestInputs:
+    def test_inputs_valid(self):
+        inputs = Inputs(dry_run=True, max_idle_days=0)
+        assert inputs.dry_run is True
+        assert inputs.max_idle_days == 0
+
+    @pytest.mark.parametrize("dry_run, max_idle_days", [
+        (True, -1),
+        (True, "7"),
+        (True, False),
+        ("true", 7),
+    ])
+    def test_inputs_invalid(self, dry_run, max_idle_days):
+        with pytest.raises(ValueError):
+            Inputs(dry_run=dry_run, max_idle_days=max_idle_days)
 
 
 class TestGetAuth:
@@ -63,6 +93,14 @@ class TestGetAuth:
             gh = get_auth()
             assert gh is not None
             mock_github.assert_called_once()
+            assert mock_github.call_args.kwargs["pool_size"] == 32
+            assert mock_github.call_args.kwargs["retry"].total == 5
+
+    def test_get_auth_cached(self, monkeypatch):
+        monkeypatch.setenv("GH_TOKEN", "valid_token")
+        with patch("pkg_32828.run.Github") as mock_github:
+            assert get_auth() is get_auth()
+            mock_github.assert_called_once()
 
     def test_get_auth_missing_token(self, monkeypatch):
         if "GH_TOKEN" in os.environ:
@@ -102,6 +140,28 @@ class TestGetRepo:
             repo_url = "git@github.com:owner/repo.git"
             assert get_repo(gh, repo_url)
 
+    @pytest.mark.parametrize("repo_url", [
+        "https://github.com/owner/repo",
+        "https://github.com/owner/repo.git",
+        "https://github.com/owner/repo/",
+        "git@github.com:owner/repo.git",
+    ])
+    def test_owner_repo_parsing(self, repo_url):
+        gh = Mock()
+        get_repo(gh, repo_url)
+        gh.get_repo.assert_called_once_with("owner/repo")
+
+    def test_repo_cached(self):
+        gh = Mock()
+        assert get_repo(gh, "https://github.com/owner/repo") is get_repo(gh, "git@github.com:owner/repo.git")
+        gh.get_repo.assert_called_once_with("owner/repo")
+
+    def test_invalid_url(self):
+        gh = Mock()
+        with pytest.raises(ValueError):
+            get_repo(gh, "https://github-test.com/owner/repo.git")
+        gh.get_repo.assert_not_called()
+
 
 class TestGetSetUserExcludeBranches:
     def test_set_exclude_branches_success_01(self):
@@ -109,47 +169,112 @@ class TestGetSetUserExcludeBranches:
         expected_string = 'test3'
         set_user_exclude_branches = build_set_exclude_branches(exclude_branches)
 
-        assert isinstance(set_user_exclude_branches, set) is True
+        assert isinstance(set_user_exclude_branches, frozenset) is True
         assert expected_string in set_user_exclude_branches
 
     def test_set_exclude_branches_success_02(self):
         exclude_branches = ''
         set_user_exclude_branches = build_set_exclude_branches(exclude_branches)
 
-        assert isinstance(set_user_exclude_branches, set) is True
+        assert isinstance(set_user_exclude_branches, frozenset) is True
 
     def test_set_exclude_branches_failure_01(self):
         exclude_branches = []  # wrong data type
         set_user_exclude_branches = build_set_exclude_branches(exclude_branches)  # type: ignore reportArgumentType
 
-        assert isinstance(set_user_exclude_branches, set) is True
+        assert isinstance(set_user_exclude_branches, frozenset) is True
 
 
-class TestGetExemptBranches:
-    def test_exempt_branches_01(self, mock_repo, mock_branch, mock_pull):
-        # mock protected branches
-        protected_branch_01 = mock_branch("protected_01", protected=True)
-
-        # mock normal branches
-        normal_branch_01 = mock_branch("normal_01", protected=False, last_commit_days_ago=10)
-        normal_branch_02 = mock_branch("normal_02", protected=False, last_commit_days_ago=15)
-
-        # get all mock branches
-        mock_repo.get_branches.return_value = [
-            protected_branch_01,
-            normal_branch_01,
-            normal_branch_02,
+class TestPaginateGql:
+    def test_paginate_gql_follows_cursor(self):
+        requester = Mock()
+        requester.graphql_query.side_effect = [
+            ({}, {"data": {"repository": {"refs": {
+                "pageInfo": {"endCursor": "cursor-1", "hasNextPage": True}, "nodes": [{"name": "a"}]}}}}),
+            ({}, {"data": {"repository": {"refs": {
+                "pageInfo": {"endCursor": "cursor-2", "hasNextPage": False}, "nodes": [{"name": "b"}]}}}}),
+        ]
+
+        pages = list(_paginate_gql(requester, "query", {"owner": "owner"}, ["repository", "refs"]))
+
+        assert pages == [[{"name": "a"}], [{"name": "b"}]]
+        assert requester.graphql_query.call_args_list[0].args[1] == {"owner": "owner", "cursor": None}
+        assert requester.graphql_query.call_args_list[1].args[1] == {"owner": "owner", "cursor": "cursor-1"}
+
+
+class TestFetchBranchGraph:
+    def test_fetch_branch_graph(self, mock_repo):
+        mock_repo.full_name = "owner/repo"
+        refs_page_01 = {"data": {"repository": {"refs": {
+            "pageInfo": {"endCursor": "ref-cursor-1", "hasNextPage": True},
+            "nodes": [
+                {"name": "main", "branchProtectionRule": {"id": "rule-1"}, "refUpdateRule": {"pattern": "main"},
+                 "rules": {"totalCount": 0}, "target": {"committedDate": "2025-01-01T00:00:00Z"}},
+            ],
+        }}}}
+        refs_page_02 = {"data": {"repository": {"refs": {
+            "pageInfo": {"endCursor": "ref-cursor-2", "hasNextPage": False},
+            "nodes": [
+                {"name": "feature1", "branchProtectionRule": None, "refUpdateRule": None,
+                 "rules": {"totalCount": 0}, "target": {"committedDate": "2025-02-01T00:00:00Z"}},
+            ],
+        }}}}
+        pulls_page_01 = {"data": {"repository": {"pullRequests": {
+            "pageInfo": {"endCursor": "pr-cursor-1", "hasNextPage": False},
+            "nodes": [{"baseRefName": "main", "headRefName": "feature1"}],
+        }}}}
+        mock_repo.requester.graphql_query.side_effect = [
+            ({}, refs_page_01),
+            ({}, refs_page_02),
+            ({}, pulls_page_01),
         ]
 
-        # mock PRs
-        pull_01 = mock_pull("main", "feature1")
-        pull_02 = mock_pull("dev", "feature2")
-        mock_repo.get_pulls.return_value = [pull_01, pull_02]
+        branches, pr_refs, default_branch = _fetch_branch_graph(mock_repo)
+
+        assert mock_repo.requester.graphql_query.call_count == 3
+        assert branches == [
+            Branch("main", datetime(2025, 1, 1, tzinfo=timezone.utc), protected=True),
+            Branch("feature1", datetime(2025, 2, 1, tzinfo=timezone.utc), protected=False),
+        ]
+        assert pr_refs == [("main", "feature1")]
+        assert default_branch == "main"
+        mock_repo.get_branches.assert_not_called()
+        mock_repo.get_pulls.assert_not_called()
+
+    @pytest.mark.parametrize("protection", [
+        {"branchProtectionRule": None, "refUpdateRule": None, "rules": {"totalCount": 1}},
+        {"branchProtectionRule": None, "refUpdateRule": {"pattern": "release/*"}, "rules": {"totalCount": 0}},
+    ])
+    def test_fetch_branch_graph_ruleset_or_non_admin_protection(self, mock_repo, protection):
+        mock_repo.full_name = "owner/repo"
+        refs_page_01 = {"data": {"repository": {"refs": {
+            "pageInfo": {"endCursor": "ref-cursor-1", "hasNextPage": False},
+            "nodes": [{"name": "release/1.0", **protection, "target": {"committedDate": "2025-01-01T00:00:00Z"}}],
+        }}}}
+        pulls_page_01 = {"data": {"repository": {"pullRequests": {
+            "pageInfo": {"endCursor": None, "hasNextPage": False}, "nodes": [],
+        }}}}
+        mock_repo.requester.graphql_query.side_effect = [({}, refs_page_01), ({}, pulls_page_01)]
+
+        branches, _, _ = _fetch_branch_graph(mock_repo)
+
+        assert branches == [Branch("release/1.0", datetime(2025, 1, 1, tzinfo=timezone.utc), protected=True)]
+
+
+class TestGetExemptBranches:
+    def test_exempt_branches_01(self, mock_branch_graph):
+        # mock branches, PRs, and protected branches
+        branch_graph = mock_branch_graph(
+            branches={"protected_01": 0, "normal_01": 10, "normal_02": 15},
+            pr_refs=[("main", "feature1"), ("dev", "feature2")],
+            protected={"protected_01"},
+        )
 
         # create exempt set
-        exempt = get_exempt_branches(mock_repo, set_exclude_branches=set(["branch-not-in-all"]))
+        exempt = get_exempt_branches(branch_graph, set_exclude_branches=frozenset(["branch-not-in-all"]))
 
         # assert branches in or not in exempt
+        assert isinstance(exempt, frozenset)
         assert "protected_01" in exempt
         assert "normal_01" not in exempt
         assert "normal_02" not in exempt
@@ -159,28 +284,16 @@ class TestGetExemptBranches:
         assert "feature2" in exempt
         assert "branch-not-in-all" not in exempt
 
-    def test_exempt_branches_02(self, mock_repo, mock_branch, mock_pull):
-        # mock protected branches
-        protected_branch_01 = mock_branch("protected_01", protected=True)
-
-        # mock normal branches
-        normal_branch_01 = mock_branch("normal_01", protected=False, last_commit_days_ago=10)
-        normal_branch_02 = mock_branch("normal_02", protected=False, last_commit_days_ago=15)
-
-        # get all mock branches
-        mock_repo.get_branches.return_value = [
-            protected_branch_01,
-            normal_branch_01,
-            normal_branch_02,
-        ]
-
-        # mock PRs
-        pull_01 = mock_pull("main", "feature1")
-        pull_02 = mock_pull("dev", "feature2")
-        mock_repo.get_pulls.return_value = [pull_01, pull_02]
+    def test_exempt_branches_02(self, mock_branch_graph):
+        # mock branches, PRs, and protected branches
+        branch_graph = mock_branch_graph(
+            branches={"protected_01": 0, "normal_01": 10, "normal_02": 15},
+            pr_refs=[("main", "feature1"), ("dev", "feature2")],
+            protected={"protected_01"},
+        )
 
         # create exempt set
-        exempt = get_exempt_branches(mock_repo, set_exclude_branches=set())
+        exempt = get_exempt_branches(branch_graph, set_exclude_branches=frozenset())
 
         # assert branches in or not in exempt
         assert "protected_01" in exempt
@@ -191,62 +304,163 @@ class TestGetExemptBranches:
         assert "feature1" in exempt
         assert "feature2" in exempt
 
+    def test_exempt_branches_protected_already_exempt(self, mock_branch_graph, capsys):
+        # mock default and user excluded branches that are also protected
+        branch_graph = mock_branch_graph(
+            branches={"main": 0, "release": 0, "protected_01": 0},
+            protected={"main", "release", "protected_01"},
+        )
+
+        exempt = get_exempt_branches(branch_graph, set_exclude_branches=frozenset({"release"}))
+        captured = capsys.readouterr()
+
+        assert exempt == {"main", "release", "protected_01"}
+        assert "Protected Branch         : protected_01" in captured.out
+        assert "Protected Branch         : main" not in captured.out
+        assert "Protected Branch         : release" not in captured.out
+
 
 class TestGetBranchesToDelete:
-    def test_branches_to_delete(self, mock_repo, mock_branch):
-        normal_branch_01 = mock_branch("normal_01", protected=False, last_commit_days_ago=10)
-        normal_branch_02 = mock_branch("normal_02", protected=False, last_commit_days_ago=15)
-        normal_branch_03 = mock_branch("normal_03", protected=False, last_commit_days_ago=5)
-        normal_branch_04 = mock_branch("normal_04", protected=False, last_commit_days_ago=12)
-        normal_branch_05 = mock_branch("normal_05", protected=False, last_commit_days_ago=20)
-        normal_branch_06 = mock_branch("normal_06", protected=False, last_commit_days_ago=10)
-
-        # get all mock branches
-        mock_repo.get_branches.return_value = [
-            main,
-            normal_branch_01,
-            normal_branch_02,
-            normal_branch_03,
-            normal_branch_04,
-            normal_branch_05,
-            normal_branch_06,
-        ]
+    def test_branches_to_delete(self, mock_branch_graph):
+        # mock branches with last commit days ago
+        branch_graph = mock_branch_graph(branches={
+            "main": 0,
+            "normal_01": 10,
+            "normal_02": 15,
+            "normal_03": 5,
+            "normal_04": 12,
+            "normal_05": 20,
+            "normal_06": 10,
+        })
 
         max_idle_days = 7
-        exempt_branches = {"main", "normal_01", "normal_02"}
+        exempt_branches = frozenset({"main", "normal_01", "normal_02"})
         cutoff_datetime = datetime.now(timezone.utc) - timedelta(days=max_idle_days)
         list_branches_to_delete, not_exempt_branch_count =\
-            get_branches_to_delete(mock_repo, exempt_branches, cutoff_datetime)
+            get_branches_to_delete(branch_graph, exempt_branches, cutoff_datetime)
 
         # Total branches (7) - Exempt branches (3) = not_exempt_branch_count (4)
         # not_exempt_branch_count                  = not in list_branches_to_delete (1) + list_branches_to_delete (3)
+        names_to_delete = [branch.name for branch in list_branches_to_delete]
         assert not_exempt_branch_count == 4
         assert len(list_branches_to_delete) == 3
-        assert "normal_03" not in list_branches_to_delete
-        assert "normal_04" in list_branches_to_delete
-        assert "normal_05" in list_branches_to_delete
-        assert "normal_06" in list_branches_to_delete
+        assert "normal_03" not in names_to_delete
+        assert "normal_04" in names_to_delete
+        assert "normal_05" in names_to_delete
+        assert "normal_06" in names_to_delete
+        assert all(isinstance(branch, Branch) for branch in list_branches_to_delete)
+
+    def test_branches_to_delete_oldest_first(self):
+        cutoff_datetime = datetime(2025, 6, 1, tzinfo=timezone.utc)
+        branch_graph = ([
+            Branch("at_cutoff", cutoff_datetime),
+            Branch("older", datetime(2025, 3, 1, tzinfo=timezone.utc)),
+            Branch("newer", datetime(2025, 7, 1, tzinfo=timezone.utc)),
+            Branch("oldest", datetime(2025, 1, 1, tzinfo=timezone.utc)),
+            Branch("exempt_old", datetime(2025, 2, 1, tzinfo=timezone.utc)),
+        ], [], "main")
+
+        list_branches_to_delete, not_exempt_branch_count =\
+            get_branches_to_delete(branch_graph, frozenset({"exempt_old"}), cutoff_datetime)
+
+        assert [branch.name for branch in list_branches_to_delete] == ["oldest", "older"]
+        assert not_exempt_branch_count == 4
 
 
 class TestDeleteBranches:
-    def test_delete_with_branches_to_delete(self, mock_repo, mock_branch, capsys):
+    def test_delete_with_branches_to_delete(self, mock_repo, capsys):
         dry_run = False
         max_idle_days = 7
         not_exempt_branch_count = 4
+        now = datetime.now(timezone.utc)
 
-        list_branches_to_delete = ["normal_04", "normal_05", "normal_06"]
-
-        mock_repo.get_branch(side_effect=[
-            mock_branch("normal_04", last_commit_days_ago=12),
-            mock_branch("normal_05", last_commit_days_ago=20),
-            mock_branch("normal_06", last_commit_days_ago=10)
-        ])
+        mock_repo.url = "https://api.github.com/repos/owner/repo"
+        list_branches_to_delete = [
+            Branch("normal_04", now - timedelta(days=12)),
+            Branch("normal_05", now - timedelta(days=20)),
+            Branch("feature/normal_06", now - timedelta(days=10)),
+        ]
 
         delete_branches(mock_repo, dry_run, max_idle_days, list_branches_to_delete, not_exempt_branch_count)
         captured = capsys.readouterr()
 
         assert "branch is idle more than" in captured.out
         assert "normal" in captured.out
+        assert mock_repo.requester.requestJsonAndCheck.call_count == 3
+        mock_repo.requester.requestJsonAndCheck.assert_any_call(
+            "DELETE", "https://api.github.com/repos/owner/repo/git/refs/heads/feature/normal_06")
+        mock_repo.get_branch.assert_not_called()
+
+    def test_delete_dry_run(self, mock_repo, capsys):
+        dry_run = True
+        max_idle_days = 7
+        not_exempt_branch_count = 4
+
+        list_branches_to_delete = [Branch("normal_04", datetime.now(timezone.utc) - timedelta(days=12))]
+
+        delete_branches(mock_repo, dry_run, max_idle_days, list_branches_to_delete, not_exempt_branch_count)
+        captured = capsys.readouterr()
+
+        assert "(MOCK) Delete branch" in captured.out
+        mock_repo.requester.requestJsonAndCheck.assert_not_called()
+
+    def test_delete_failure_does_not_abort_batch(self, mock_repo, capsys):
+        now = datetime.now(timezone.utc)
+        mock_repo.url = "https://api.github.com/repos/owner/repo"
+        list_branches_to_delete = [
+            Branch("normal_04", now - timedelta(days=12)),
+            Branch("normal_05", now - timedelta(days=20)),
+        ]
+
+        def _request(verb, url):
+            if url.endswith("normal_04"):
+                raise GithubException(422, {"message": "Reference does not exist"}, {})
+            return {}, None
+
+        mock_repo.requester.requestJsonAndCheck.side_effect = _request
+
+        with pytest.raises(RuntimeError, match="1 of 2 branch"):
+            delete_branches(mock_repo, False, 7, list_branches_to_delete, 4)
+        captured = capsys.readouterr()
+
+        assert "normal_04 (422)" in captured.out
+        assert "✅ Delete branch" in captured.out
+        assert "normal_05" in captured.out
+
+    def test_delete_connection_error_does_not_abort_batch(self, mock_repo, capsys):
+        now = datetime.now(timezone.utc)
+        mock_repo.url = "https://api.github.com/repos/owner/repo"
+        list_branches_to_delete = [
+            Branch("normal_04", now - timedelta(days=12)),
+            Branch("normal_05", now - timedelta(days=20)),
+        ]
+
+        def _request(verb, url):
+            if url.endswith("normal_04"):
+                raise requests.exceptions.ConnectionError("connection reset")
+            return {}, None
+
+        mock_repo.requester.requestJsonAndCheck.side_effect = _request
+
+        with pytest.raises(RuntimeError, match="1 of 2 branch"):
+            delete_branches(mock_repo, False, 7, list_branches_to_delete, 4)
+        captured = capsys.readouterr()
+
+        assert "normal_04 (ConnectionError)" in captured.out
+        assert "✅ Delete branch" in captured.out
+        assert mock_repo.requester.requestJsonAndCheck.call_count == 2
+
+    @pytest.mark.parametrize("status, headers", [
+        (429, {"retry-after": "1"}),
+        (403, {}),
+    ])
+    def test_delete_one_leaves_retries_to_transport(self, mock_repo, status, headers):
+        mock_repo.url = "https://api.github.com/repos/owner/repo"
+        mock_repo.requester.requestJsonAndCheck.side_effect = GithubException(status, {"message": "failed"}, headers)
+
+        with pytest.raises(GithubException):
+            _delete_one(mock_repo, "normal_04", dry_run=False)
+        assert mock_repo.requester.requestJsonAndCheck.call_count == 1
 
     def test_delete_without_branches_to_delete(self, mock_repo, capsys):
         dry_run = False
@@ -321,6 +535,46 @@ class TestMainCommand:
         captured = capsys.readouterr()
         print(captured)
 
+    def test_main_dry_run_negative_max_idle_days(self):
+        runner = CliRunner()
+        with patch("pkg_32828.run.get_auth") as mock_get_auth:
+            result = runner.invoke(
+                main,
+                [
+                    "--dry-run", "true",
+                    "--repo-url", "https://github.com/tagdots-dev/branch-test",
+                    "--max-idle-days", "-1"
+                ]
+            )
+
+        # assertions
+        assert result.exit_code > 0
+        assert "max-idle-days (-1) must be an integer of zero or more" in result.stdout
+        mock_get_auth.assert_not_called()
+
+    def test_main_delete_failure_exit_code(self, mock_repo):
+        mock_repo.url = "https://api.github.com/repos/owner/repo"
+        mock_repo.requester.requestJsonAndCheck.side_effect = GithubException(422, {"message": "failed"}, {})
+        branch_graph = ([Branch("normal_01", datetime.now(timezone.utc) - timedelta(days=30))], [], "main")
+
+        runner = CliRunner()
+        with patch("pkg_32828.run.get_auth"), \
+                patch("pkg_32828.run.get_repo", return_value=mock_repo), \
+                patch("pkg_32828.run._fetch_branch_graph", return_value=branch_graph):
+            result = runner.invoke(
+                main,
+                [
+                    "--dry-run", "false",
+                    "--repo-url", "https://github.com/owner/repo",
+                    "--max-idle-days", "7"
+                ]
+            )
+
+        # assertions
+        assert result.exit_code == 1
+        assert "normal_01 (422)" in result.stdout
+        assert "Error: 1 of 1 branch(es) failed to delete" in result.stdout
+
     def test_main_dry_run_url_not_found(self, capsys):
         runner = CliRunner()
         result = runner.invoke(